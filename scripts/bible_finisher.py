@@ -1,29 +1,93 @@
 import os
 import json
+import random
+import time
 from google import genai
+from google.genai import types
 
-client = genai.Client(api_key=os.environ["GOOGLE_API_KEY"])
+# Bounded per-attempt timeout + retries so one stuck request can't hang
+# the whole run (chapters are generated in a long loop).
+client = genai.Client(
+    api_key=os.environ["GOOGLE_API_KEY"],
+    http_options=types.HttpOptions(
+        timeout=60_000,
+        retry_options=types.HttpRetryOptions(attempts=3, initial_delay=1.0, exp_base=2.0)
+    )
+)
 BIBLE_PATH = "scripts/narrative_bible.json"
+DIGEST_PATH = "scripts/narrative_digest.json"
+VERBATIM_TAIL = 20  # chapters always sent verbatim; everything older is digested
+MAX_ATTEMPTS = 3
+
+def load_digest():
+    if os.path.exists(DIGEST_PATH):
+        with open(DIGEST_PATH, "r") as f:
+            return json.load(f)
+    return {"summary": "", "through_chapter": 0}
+
+def save_digest(digest):
+    with open(DIGEST_PATH, "w") as f:
+        json.dump(digest, f, separators=(',', ':'))
+
+def update_digest(digest, bible):
+    # Fold any chapters older than the verbatim tail into the running
+    # summary, so prompt size stays bounded no matter how long the bible
+    # grows (sending the full history is O(N^2) tokens over the run and
+    # overflows the context window before chapter 500).
+    cutoff = len(bible) - VERBATIM_TAIL
+    pending = [ch for ch in bible[:cutoff] if ch.get("chapter", 0) > digest["through_chapter"]]
+    if not pending:
+        return digest
+
+    prompt = f"""
+    You maintain the canon digest of the 'Worst Day in Leipzig' Surrealist Saga.
+
+    CURRENT DIGEST (chapters 1 to {digest['through_chapter']}):
+    {digest['summary'] or '(empty)'}
+
+    NEW CHAPTERS TO FOLD IN:
+    {json.dumps(pending)}
+
+    Rewrite the digest to cover everything through chapter {pending[-1]['chapter']}.
+    Keep every recurring location, character, item, and theme. Max 500 words.
+    Output the digest text only.
+    """
+
+    response = client.models.generate_content(
+        model='gemini-2.5-flash',
+        contents=prompt
+    )
+    digest = {"summary": response.text.strip(), "through_chapter": pending[-1]["chapter"]}
+    save_digest(digest)
+    return digest
 
 def finish_the_bible_with_total_memory():
     with open(BIBLE_PATH, "r") as f:
         bible = json.load(f)
-    
+
+    digest = load_digest()
+
     while len(bible) < 500:
         start_ch = bible[-1]["chapter"] + 1
         # We generate in chunks of 50 to ensure we don't hit the OUTPUT limit
         end_ch = min(start_ch + 49, 500)
-        
-        # OPTIMAL CONTEXT: We send the ENTIRE Bible generated so far
-        # This ensures the 500th chapter is perfectly consistent with the 1st
-        full_history = json.dumps(bible)
-        
+
+        # BOUNDED CONTEXT: a rolling digest of old chapters plus the last
+        # few verbatim keeps consistency without resending the whole bible.
+        digest = update_digest(digest, bible)
+        tail = bible[-VERBATIM_TAIL:]
+        history = f"""CANON DIGEST (chapters 1 to {digest['through_chapter']}):
+        {digest['summary'] or '(nothing yet)'}
+
+        MOST RECENT {len(tail)} CHAPTERS (VERBATIM):
+        {json.dumps(tail)}"""
+
         prompt = f"""
         You are the Master Architect of the 'Worst Day in Leipzig' Surrealist Saga.
-        
-        FULL NARRATIVE HISTORY SO FAR:
-        {full_history}
-        
+
+        NARRATIVE HISTORY SO FAR:
+        {history}
+
         TASK:
         Generate the next 50 chapters (Chapters {start_ch} to {end_ch}).
         
@@ -38,25 +102,47 @@ def finish_the_bible_with_total_memory():
         Output format: JSON list of objects only.
         """
         
-        print(f"--- Generating Chapters {start_ch} to {end_ch} with Full History... ---")
-        try:
-            response = client.models.generate_content(
-                model='gemini-2.5-flash',
-                contents=prompt,
-                config={'response_mime_type': 'application/json'}
-            )
-            
-            new_chapters = json.loads(response.text)
-            bible.extend(new_chapters)
-            
-            with open(BIBLE_PATH, "w") as f:
-                json.dump(bible, f, indent=2)
-            print(f"Current Progress: {len(bible)}/500 chapters.")
-            
-        except Exception as e:
-            print(f"Error at {start_ch}: {e}. Retrying with full history...")
-            continue
+        print(f"--- Generating Chapters {start_ch} to {end_ch} with Canon Digest... ---")
+
+        # Bounded retries with jittered backoff. The old bare `continue`
+        # busy-looped forever, re-sending the same prompt even on
+        # permanent 400s and burning tokens with every spin.
+        new_chapters = None
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                response = client.models.generate_content(
+                    model='gemini-2.5-flash',
+                    contents=prompt,
+                    config={'response_mime_type': 'application/json', 'max_output_tokens': 8192}
+                )
+                new_chapters = json.loads(response.text)
+                break
+            except Exception as e:
+                msg = str(e)
+                if 'INVALID_ARGUMENT' in msg or 'PERMISSION_DENIED' in msg:
+                    # Permanent request error — retrying the same payload can't help.
+                    print(f"Permanent error at {start_ch}: {e}. Aborting run.")
+                    return
+                wait = 2 ** attempt + random.random()
+                print(f"Error at {start_ch} (attempt {attempt + 1}/{MAX_ATTEMPTS}): {e}. Backing off {wait:.1f}s...")
+                time.sleep(wait)
+
+        if new_chapters is None:
+            print(f"Giving up on chapters {start_ch} to {end_ch} after {MAX_ATTEMPTS} attempts.")
+            return
+
+        bible.extend(new_chapters)
+
+        # Single buffered write; compact separators for the incremental
+        # checkpoint — pretty-printing doubles the bytes rewritten every
+        # 50 chapters for no reader benefit mid-run.
+        with open(BIBLE_PATH, "wb", buffering=1 << 20) as f:
+            f.write(json.dumps(bible, separators=(',', ':')).encode("utf-8"))
+        print(f"Current Progress: {len(bible)}/500 chapters.")
 
+    # Final human-facing artifact gets the indent.
+    with open(BIBLE_PATH, "wb", buffering=1 << 20) as f:
+        f.write(json.dumps(bible, indent=2).encode("utf-8"))
     print("🏁 THE BIBLE IS COMPLETE. 500 chapters of internally consistent Leipzig Purgatory.")
 
 if __name__ == "__main__":
@@ -1,13 +1,20 @@
 import os
 import json
 from google import genai
+from google.genai import types
 
 # Configuration
 MASTER_LOCATION = "Leipzig, Germany"
 TOTAL_CHAPTERS = 500
 
 def generate_narrative_bible():
-    client = genai.Client(api_key=os.environ["GOOGLE_API_KEY"])
+    client = genai.Client(
+        api_key=os.environ["GOOGLE_API_KEY"],
+        http_options=types.HttpOptions(
+            timeout=120_000,
+            retry_options=types.HttpRetryOptions(attempts=3, initial_delay=1.0, exp_base=2.0)
+        )
+    )
     
     prompt = f"""
     Create a Master Narrative Bible for a 500-chapter surrealist story set in {MASTER_LOCATION}.
@@ -1,18 +1,53 @@
 
 from google import genai
 from google.genai import types
+import asyncio
 import csv
+import httpx
 import json
 import time
 import os
 import argparse
+import hashlib
+import itertools
 import traceback
 import random
 import io
 import datetime
+import shutil
+from collections import deque
 from pathlib import Path
 from PIL import Image
 
+# Optional fast image backend: pyvips (libvips) resizes+encodes several
+# times faster than stock Pillow. Fall back to PIL when absent.
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+# Optional fast JSON backend for the large stories/bible payloads;
+# stdlib json remains the fallback.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def json_dumps_line(obj):
+    # Compact single-line form (bytes) for the JSONL stream.
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def json_dumps_pretty_bytes(obj):
+    # indent=2 form for the shipped artifacts.
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+
 # Configuration & Path Safety
 SCRIPT_DIR = Path(__file__).parent.absolute()
 PROJECT_ROOT = SCRIPT_DIR.parent
@@ -20,63 +55,261 @@ ASSETS_DIR = PROJECT_ROOT / "app/src/main/assets"
 CSV_PATH = PROJECT_ROOT / "app/src/main/res/raw/german_4000.csv"
 BIBLE_PATH = SCRIPT_DIR / "narrative_bible.json"
 OUTPUT_JSON = ASSETS_DIR / "stories.json"
+OUTPUT_JSONL = ASSETS_DIR / "stories.jsonl"
+CACHE_STATE_PATH = SCRIPT_DIR / ".cache_state.json"
+IMAGE_CACHE_PATH = SCRIPT_DIR / ".image_cache.json"
+CACHE_TTL_SECONDS = 3600
+CACHE_REUSE_MARGIN = 100  # don't reuse a cache about to expire mid-run
 BATCH_SIZE = 10
 LEGACY_POOL_SIZE = 5
 ANCHOR_POOL_SIZE = 100
+VOCAB_LIMIT = 2000
+MAX_CONCURRENCY = 8
+IMAGE_BATCH = 4
+LEVELS_PER_CALL = 4
+MAX_OUTPUT_TOKENS = 2048
+GEN_TEMPERATURE = 0.7
+RPM_LIMIT = 60
+TPM_LIMIT = 100_000
+
+class RateLimiter:
+    """Sliding-window RPM/TPM token bucket with AIMD backoff.
+
+    Replaces the old blind time.sleep between batches: callers acquire()
+    before each API call and only wait when the window is actually full.
+    On a 429 the allowed RPM halves; each success nudges it back up.
+    """
+
+    def __init__(self, rpm=RPM_LIMIT, tpm=TPM_LIMIT):
+        self.target_rpm = rpm
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = deque()   # monotonic timestamps of recent calls
+        self._tokens = deque()     # (timestamp, estimated_tokens)
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens=512):
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                cutoff = now - 60
+                while self._requests and self._requests[0] < cutoff:
+                    self._requests.popleft()
+                while self._tokens and self._tokens[0][0] < cutoff:
+                    self._tokens.popleft()
+
+                tokens_used = sum(t for _, t in self._tokens)
+                if len(self._requests) < self.rpm and tokens_used + estimated_tokens <= self.tpm:
+                    self._requests.append(now)
+                    self._tokens.append((now, estimated_tokens))
+                    return
+                wait = (self._requests[0] - cutoff) if self._requests else 1.0
+            await asyncio.sleep(max(wait, 0.1))
+
+    def backoff(self):
+        # Multiplicative decrease on ResourceExhausted/429.
+        self.rpm = max(1, self.rpm // 2)
+        print(f"  [!] Rate limited. Shrinking to {self.rpm} RPM.")
+
+    def recover(self):
+        # Additive increase back toward the configured target.
+        if self.rpm < self.target_rpm:
+            self.rpm += 1
+
+def is_rate_limit_error(e):
+    msg = str(e)
+    return '429' in msg or 'RESOURCE_EXHAUSTED' in msg or 'ResourceExhausted' in type(e).__name__
+
+def is_permanent_error(e):
+    # Non-429 4xx responses won't succeed on retry.
+    msg = str(e)
+    return any(marker in msg for marker in
+               ('400', '401', '403', '404', 'INVALID_ARGUMENT', 'PERMISSION_DENIED', 'NOT_FOUND'))
+
+RETRY_ATTEMPTS = 5
+
+async def with_retries(limiter, label, call, estimated_tokens=512):
+    """Run a zero-arg coroutine factory with bounded backoff + jitter.
+
+    Each attempt goes through the rate limiter; 429s shrink the limiter
+    window, permanent 4xx errors re-raise immediately, everything else
+    retries with capped exponential backoff. A transient 503 no longer
+    silently kills a level."""
+    for attempt in range(RETRY_ATTEMPTS):
+        await limiter.acquire(estimated_tokens=estimated_tokens)
+        try:
+            result = await call()
+            limiter.recover()
+            return result
+        except Exception as e:
+            if isinstance(e, (TypeError, ValueError)):
+                # Client-side (SDK argument validation) failure: the
+                # request never left the machine, so retrying the same
+                # payload just burns the backoff ladder.
+                print(f"  [!] {label}: client-side error, not retrying: {e}")
+                raise
+            if is_rate_limit_error(e):
+                limiter.backoff()
+            elif is_permanent_error(e):
+                print(f"  [!] {label}: permanent error, not retrying: {e}")
+                raise
+            if attempt == RETRY_ATTEMPTS - 1:
+                raise
+            wait = min(30, 2 ** attempt) + random.random()
+            print(f"  [!] {label}: attempt {attempt + 1}/{RETRY_ATTEMPTS} failed ({e}); retrying in {wait:.1f}s")
+            await asyncio.sleep(wait)
 
 def setup_args():
     parser = argparse.ArgumentParser(description="Generate 'Magritte-Style' German CYOA stories.")
     parser.add_argument("--limit", type=int, default=1, help="Limit the number of batches to process (default: 1).")
     parser.add_argument("--start-batch", type=int, default=0, help="Force start from specific batch ID (optional).")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY, help=f"Max levels in flight at once (default: {MAX_CONCURRENCY}).")
+    parser.add_argument("--realtime", action="store_true", help="Use interactive per-level calls instead of the Batch API (full price, lower latency).")
+    parser.add_argument("--levels-per-call", type=int, default=LEVELS_PER_CALL, help=f"Levels fused into one realtime LLM request (default: {LEVELS_PER_CALL}).")
+    parser.add_argument("--compact", action="store_true", help="Fold stories.jsonl into stories.json and exit (no generation).")
     return parser.parse_args()
 
 def configure_client():
     api_key = os.environ.get("GOOGLE_API_KEY")
     if not api_key:
         raise ValueError("GOOGLE_API_KEY environment variable not set.")
-    return genai.Client(api_key=api_key)
+    # HTTP/2 lets all concurrent Gemini/Imagen calls multiplex over one
+    # connection instead of opening a TCP+TLS handshake per request.
+    # Requires httpx[http2] (h2) to be installed.
+    # A stuck request should fail fast and retry, not hang the run:
+    # 60s cap per attempt, 3 attempts with exponential backoff.
+    pool_limits = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0)
+    http_options = types.HttpOptions(
+        timeout=60_000,
+        retry_options=types.HttpRetryOptions(attempts=3, initial_delay=1.0, exp_base=2.0),
+        async_client_args={
+            'http2': True,
+            'timeout': httpx.Timeout(600, connect=5),
+            'limits': pool_limits,
+        },
+        # Same pooling for the sync transport (cache/batch management
+        # calls), so the ~100-500KB image downloads and polling requests
+        # reuse warm TLS sessions instead of renegotiating each time.
+        client_args={
+            'http2': True,
+            'limits': pool_limits,
+        }
+    )
+    return genai.Client(api_key=api_key, http_options=http_options)
 
 def read_json_file(filepath):
     if not filepath.exists():
         return []
+    with open(filepath, 'rb') as f:
+        return json_loads(f.read())
+
+def load_existing_entries():
+    # Levels live in two places: the compacted stories.json array (what
+    # the app ships) and the append-only stories.jsonl stream that this
+    # run writes to. Merge both so resume sees everything.
+    entries = []
+    if OUTPUT_JSON.exists():
+        try:
+            with open(OUTPUT_JSON, 'rb') as f:
+                entries = json_loads(f.read())
+        except Exception:
+            entries = []
+    if OUTPUT_JSONL.exists():
+        with open(OUTPUT_JSONL, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json_loads(line))
+                except ValueError:
+                    print("  [!] Skipping corrupt line in stories.jsonl")
+    return entries
+
+def append_entry(jsonl_f, entry):
+    # O(1) per level instead of rewriting the whole array every time.
+    # Writes land in the 1MB user-space buffer; durability is paid at
+    # level boundaries via checkpoint_entries, not per line.
+    jsonl_f.write(json_dumps_line(entry) + b"\n")
+
+def checkpoint_entries(jsonl_f):
+    # Flush the buffer and fsync so levels reported complete survive a
+    # crash; called at safe points (end of level/group), not per append.
+    jsonl_f.flush()
+    os.fsync(jsonl_f.fileno())
+
+def compact_stories():
+    entries = load_existing_entries()
+    if not entries:
+        print("Nothing to compact.")
+        return
+    # Last write wins per level, sorted for the app.
+    by_level = {}
+    for e in entries:
+        by_level[e.get('level', 0)] = e
+    final = [by_level[k] for k in sorted(by_level)]
+    # Serialize once and push through a large buffer: json.dump would
+    # issue thousands of tiny write() calls for a multi-MB array.
+    with open(OUTPUT_JSON, 'wb', buffering=1 << 20) as f:
+        f.write(json_dumps_pretty_bytes(final))
+    if OUTPUT_JSONL.exists():
+        OUTPUT_JSONL.unlink()
+    print(f"Compacted {len(final)} levels into {OUTPUT_JSON}.")
+
+def iter_vocab(filepath):
+    # Stream rows instead of materializing the whole file. Plain
+    # csv.reader + one header.index() lookup: DictReader builds a dict
+    # per row, which is pure overhead when we want a single column.
     with open(filepath, 'r', encoding='utf-8') as f:
-        return json.load(f)
+        reader = csv.reader(f, delimiter='|')
+        header = next(reader, None)
+        if not header or 'german' not in header:
+            print(f"Error: No 'german' column in {filepath}")
+            return
+        idx = header.index('german')
+        for row in reader:
+            if len(row) > idx and row[idx]:
+                yield row[idx]
 
 def read_vocab(filepath):
-    words = []
     if not filepath.exists():
         print(f"Error: Vocab file not found at {filepath}")
         return []
-        
-    with open(filepath, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f, delimiter='|')
-        for row in reader:
-            if 'german' in row and row['german']:
-                words.append(row['german'])
-    
+
     # Task 1: The Lexical Bottleneck
-    # Limit to the top 2,000 words.
-    return words[:2000]
+    # islice stops parsing at the top 2,000 words, so a huge vocab file
+    # costs nothing past the cut. Anchor/legacy sampling needs random
+    # access over the retained words, hence the (bounded) list.
+    return list(itertools.islice(iter_vocab(filepath), VOCAB_LIMIT))
 
 def get_anchor_words(all_words):
     # Top 100 words (70% weight logic in prompt availability)
     return all_words[:ANCHOR_POOL_SIZE]
 
 def get_legacy_words(all_words, current_index):
-    # Pull 5 random words from previous batches (20% logic)
+    # Pull 5 random words from previous batches (20% logic).
+    # Sample indices off a range() instead of slicing a copy of the
+    # pool — random.sample has a fast path for ranges and this stays
+    # O(k) memory instead of O(current_index).
     if current_index < BATCH_SIZE:
         return []
-    pool = all_words[:current_index]
-    count = min(len(pool), LEGACY_POOL_SIZE)
-    return random.sample(pool, count)
+    count = min(current_index, LEGACY_POOL_SIZE)
+    return [all_words[i] for i in random.sample(range(current_index), count)]
+
+# Memoized: the bible dump is O(bible-size) and the instruction is
+# needed by both cache creation and batch submission in the same run;
+# bible/anchors never change within a process.
+_system_instruction_cache = None
+
+def build_system_instruction(bible_data, anchor_words):
+    global _system_instruction_cache
+    if _system_instruction_cache is not None:
+        return _system_instruction_cache
 
-def create_story_cache(client, bible_data, anchor_words):
-    print("Creating Context Cache (The Leipzig Purgatory)...")
-    
     bible_str = json.dumps(bible_data, indent=2)
     anchors_str = ", ".join(anchor_words)
-    
-    system_instruction = f"""
+
+    _system_instruction_cache = f"""
     You are The Leipzig Surrealist, an expert German language author.
     
     **The World (Narrative Bible):**
@@ -102,10 +335,32 @@ def create_story_cache(client, bible_data, anchor_words):
     - 'sentences_m', 'sentences_f', and 'en_sentences' MUST have the exact same number of items.
     - Index [0] of 'sentences_m' must correspond to Index [0] of 'en_sentences', etc.
     """
-    
+    return _system_instruction_cache
+
+def create_story_cache(client, bible_data, anchor_words):
+    system_instruction = build_system_instruction(bible_data, anchor_words)
+    # The instruction embeds the bible and anchor words, so one hash
+    # covers everything that would invalidate the cache.
+    content_hash = hashlib.sha256(system_instruction.encode('utf-8')).hexdigest()
+
+    # Reuse a still-live cache from a previous run: cache writes carry a
+    # cost premium, so only pay it when the content actually changed.
+    if CACHE_STATE_PATH.exists():
+        try:
+            state = json.loads(CACHE_STATE_PATH.read_text())
+            age = time.time() - state.get('created', 0)
+            if state.get('hash') == content_hash and age < CACHE_TTL_SECONDS - CACHE_REUSE_MARGIN:
+                cache = client.caches.get(name=state['name'])
+                print(f"Reusing context cache from previous run: {cache.name}")
+                return state['name'], state['model']
+        except Exception as e:
+            print(f"Warning: stale cache state ignored ({e}).")
+
+    print("Creating Context Cache (The Leipzig Purgatory)...")
+
     # Attempt Primary -> Fallback
     models_to_try = ['gemini-2.5-flash', 'gemini-2.0-flash'] # Prefer 2.5
-    
+
     for model_name in models_to_try:
         try:
             print(f"Attempting cache creation with {model_name}...")
@@ -114,10 +369,16 @@ def create_story_cache(client, bible_data, anchor_words):
                 config=types.CreateCachedContentConfig(
                     display_name="leipzig_magritte_cache",
                     system_instruction=system_instruction,
-                    ttl="3600s"
+                    ttl=f"{CACHE_TTL_SECONDS}s"
                 )
             )
             print(f"Cache created: {cache.name} using {model_name}")
+            CACHE_STATE_PATH.write_text(json.dumps({
+                'hash': content_hash,
+                'name': cache.name,
+                'created': time.time(),
+                'model': model_name
+            }, separators=(',', ':')))
             return cache.name, model_name
         except Exception as e:
             print(f"Warning: Cache failed with {model_name} ({e}).")
@@ -125,187 +386,592 @@ def create_story_cache(client, bible_data, anchor_words):
     print("Masking cache failure. Will proceed with manual context injection using gemini-2.5-flash.")
     return None, 'gemini-2.5-flash'
 
-def generate_cyoa_content(client, level, new_words, legacy_words, cache_name, model_name, bible_data):
-    # Context
-    idx = (level - 1) % len(bible_data)
-    next_idx = level % len(bible_data)
-    
-    current_chapter = bible_data[idx]
-    next_chapter = bible_data[next_idx]
-    
-    context = {
-        "location": current_chapter.get("location", "Unknown"),
-        "vibe": current_chapter.get("vibe", "Normal"),
-        "destination": next_chapter.get("location", "Unknown")
-    }
-
-    words_combined_str = ", ".join(new_words + legacy_words)
-    
-    print(f"Generating LEVEL {level} [Magritte Style] @ {context['location']} -> {context['destination']} using {model_name}")
-
-    prompt = f"""
+# Prompt skeleton split into a formatted head and a fully static tail.
+# Everything variable (level, chapter context, word list) lives in the
+# head; the tail is the exact same bytes on every call, which is what
+# Gemini's implicit prefix matching needs to reuse it. (The "level"
+# field in the JSON structure now references the header instead of
+# interpolating the number — that's what makes the tail static; the
+# entry writer uses the loop's level, not the model's, so nothing
+# downstream depends on it.)
+_PROMPT_HEAD = """
     **Level:** {level}
-    **Location:** {context['location']}
-    **Vibe:** {context['vibe']} (Interpret as Magritte-style surrealism)
-    **Bottleneck Destination:** {context['destination']}
+    **Location:** {location}
+    **Vibe:** {vibe} (Interpret as Magritte-style surrealism)
+    **Bottleneck Destination:** {destination}
 
     **Constraint:**
     You are now restricted to a 2,000-word vocabulary. Use ONLY these common words to describe the complex surrealist scenes from the Narrative Bible.
-    
-    **Target Vocabulary (Must Use):** [{words_combined_str}]
-    
+
+    **Target Vocabulary (Must Use):** [{words}]
+
     **Task:**
-    1. Start at {context['location']}.
-    2. Offer TWO choices (Path A and Path B). Both must inevitably lead towards {context['destination']}.
+    1. Start at {location}.
+    2. Offer TWO choices (Path A and Path B). Both must inevitably lead towards {destination}.
     3. **Tone:** Banal Surrealism. Ordinary objects behaving strangely in broad daylight.
-    4. **Output Format:**
+"""
+
+_PROMPT_TAIL = """    4. **Output Format:**
        - Generate 2-3 sentences per path choice.
        - Return strict JSON arrays for sentences.
-       - Ensure Male/Female German versions differ only by grammatical necessity (pronouns/endings). Hero name is '{{{{HERO}}}}'.
+       - Ensure Male/Female German versions differ only by grammatical necessity (pronouns/endings). Hero name is '{{HERO}}'.
 
     **JSON Structure:**
-    {{
-      "level": {level},
-      "choice_a": {{
+    {
+      "level": <the level number from the header>,
+      "choice_a": {
          "prompt": "Choice A Label",
          "sentences_m": ["Sentence 1 (M)...", "Sentence 2 (M)..."],
          "sentences_f": ["Sentence 1 (F)...", "Sentence 2 (F)..."],
          "en_sentences": ["Sentence 1 (EN)...", "Sentence 2 (EN)..."],
          "image_prompt": "Magritte style image prompt for A..."
-      }},
-      "choice_b": {{
+      },
+      "choice_b": {
          "prompt": "Choice B Label",
          "sentences_m": ["..."],
          "sentences_f": ["..."],
          "en_sentences": ["..."],
          "image_prompt": "Magritte style image prompt for B..."
-      }}
-    }}
+      }
+    }
     """
 
-    generate_config = types.GenerateContentConfig(
-        response_mime_type='application/json'
-    )
-    
+# Schema for one level object, mirroring the **JSON Structure** block in
+# the prompt template. Validated before any image budget is spent on the
+# entry — a malformed choice used to fall through to generate_image with
+# the default "magritte scene" prompt.
+_CHOICE_SCHEMA = {
+    "type": "object",
+    "required": ["prompt", "sentences_m", "sentences_f", "en_sentences", "image_prompt"],
+    "properties": {
+        "prompt": {"type": "string", "minLength": 1},
+        "sentences_m": {"type": "array", "minItems": 1, "items": {"type": "string"}},
+        "sentences_f": {"type": "array", "minItems": 1, "items": {"type": "string"}},
+        "en_sentences": {"type": "array", "minItems": 1, "items": {"type": "string"}},
+        "image_prompt": {"type": "string", "minLength": 1},
+    },
+}
+_STORY_SCHEMA = {
+    "type": "object",
+    "required": ["choice_a", "choice_b"],
+    "properties": {"choice_a": _CHOICE_SCHEMA, "choice_b": _CHOICE_SCHEMA},
+}
+
+# Optional compiled validator (fastjsonschema compiles the schema to a
+# plain function, far faster than stock jsonschema); structural checks
+# below cover the same ground when it isn't installed.
+try:
+    import fastjsonschema
+    _compiled_story_validator = fastjsonschema.compile(_STORY_SCHEMA)
+except ImportError:
+    fastjsonschema = None
+    _compiled_story_validator = None
+
+# Extra LLM attempts (with a schema nudge) when output fails validation.
+VALIDATION_RETRIES = 2
+
+def validate_story(story):
+    """Return an error string if the story fails the level schema, else None."""
+    if _compiled_story_validator is not None:
+        try:
+            _compiled_story_validator(story)
+            return None
+        except fastjsonschema.JsonSchemaException as e:
+            return str(e)
+    if not isinstance(story, dict):
+        return "response is not a JSON object"
+    for key in ("choice_a", "choice_b"):
+        choice = story.get(key)
+        if not isinstance(choice, dict):
+            return f"{key} missing or not an object"
+        for field in ("prompt", "image_prompt"):
+            if not isinstance(choice.get(field), str) or not choice[field].strip():
+                return f"{key}.{field} missing or empty"
+        for field in ("sentences_m", "sentences_f", "en_sentences"):
+            val = choice.get(field)
+            if not isinstance(val, list) or not val or not all(isinstance(s, str) for s in val):
+                return f"{key}.{field} must be a non-empty list of strings"
+    return None
+
+def build_level_prompt(level, new_words, legacy_words, bible_data):
+    # Context
+    idx = (level - 1) % len(bible_data)
+    next_idx = level % len(bible_data)
+
+    current_chapter = bible_data[idx]
+    next_chapter = bible_data[next_idx]
+
+    context = {
+        "location": current_chapter.get("location", "Unknown"),
+        "vibe": current_chapter.get("vibe", "Normal"),
+        "destination": next_chapter.get("location", "Unknown")
+    }
+
+    # chain() feeds join directly — no throwaway concatenated list.
+    prompt = _PROMPT_HEAD.format_map({
+        'level': level,
+        'location': context['location'],
+        'vibe': context['vibe'],
+        'destination': context['destination'],
+        'words': ", ".join(map(str, itertools.chain(new_words, legacy_words)))
+    }) + _PROMPT_TAIL
+    return prompt, context
+
+async def generate_cyoa_content(client, limiter, level, new_words, legacy_words, cache_name, model_name, bible_data):
+    prompt, context = build_level_prompt(level, new_words, legacy_words, bible_data)
+
+    print(f"Generating LEVEL {level} [Magritte Style] @ {context['location']} -> {context['destination']} using {model_name}")
+
+    config_kwargs = {
+        'response_mime_type': 'application/json',
+        'max_output_tokens': MAX_OUTPUT_TOKENS,
+        'temperature': GEN_TEMPERATURE
+    }
+    if cache_name:
+        config_kwargs['cached_content'] = cache_name
+    generate_config = types.GenerateContentConfig(**config_kwargs)
+
     try:
-        if cache_name:
-             response = client.models.generate_content(
-                model=model_name,
-                contents=prompt,
-                config=types.GenerateContentConfig(
-                    response_mime_type='application/json',
-                    cached_content=cache_name
-                )
+        attempt_prompt = prompt
+        for attempt in range(VALIDATION_RETRIES + 1):
+            response = await with_retries(
+                limiter, f"text L{level}",
+                lambda p=attempt_prompt: client.aio.models.generate_content(
+                    model=model_name,
+                    contents=p,
+                    config=generate_config
+                ),
+                estimated_tokens=len(attempt_prompt) // 4 + MAX_OUTPUT_TOKENS
             )
-        else:
-             response = client.models.generate_content(
-                model=model_name,
-                contents=prompt,
-                config=generate_config
+            story = json.loads(response.text)
+            error = validate_story(story)
+            if error is None:
+                return story
+            # A schema miss costs another text call but saves the two
+            # Imagen calls a broken entry would otherwise trigger.
+            print(f"  [!] Level {level} output failed schema ({error}); retry {attempt + 1}/{VALIDATION_RETRIES}")
+            attempt_prompt = (
+                prompt
+                + f"\n\nYour previous output did not match the required **JSON Structure** ({error})."
+                + "\nReturn ONLY a JSON object matching the structure exactly."
             )
-
-        return json.loads(response.text)
+        print(f"  [!] Level {level} never produced schema-valid output; skipping.")
+        return None
     except Exception as e:
         print(f"Error generating text for level {level}: {e}")
         traceback.print_exc()
         return None
 
+async def generate_cyoa_multi(client, limiter, group, cache_name, model_name, bible_data):
+    # Fuse several level specs into one request returning a JSON array.
+    # With the cached system instruction warm, the marginal cost of each
+    # extra level in-prompt is small, so this amortizes the round-trip.
+    sections = []
+    for level, new_words, legacy_words in group:
+        section, context = build_level_prompt(level, new_words, legacy_words, bible_data)
+        print(f"Queueing LEVEL {level} [Magritte Style] @ {context['location']} -> {context['destination']} (fused call)")
+        sections.append(section)
+
+    prompt = (
+        f"Generate {len(group)} CYOA levels in ONE response.\n"
+        "Return a single top-level JSON ARRAY with exactly one object per level spec below, in order.\n"
+        "Each object must follow the **JSON Structure** given in its own spec.\n"
+        + "\n----\n".join(sections)
+    )
+
+    config_kwargs = {
+        'response_mime_type': 'application/json',
+        'max_output_tokens': MAX_OUTPUT_TOKENS * len(group),
+        'temperature': GEN_TEMPERATURE
+    }
+    if cache_name:
+        config_kwargs['cached_content'] = cache_name
+
+    try:
+        response = await with_retries(
+            limiter, f"fused text L{group[0][0]}-{group[-1][0]}",
+            lambda: client.aio.models.generate_content(
+                model=model_name,
+                contents=prompt,
+                config=types.GenerateContentConfig(**config_kwargs)
+            ),
+            estimated_tokens=len(prompt) // 4 + MAX_OUTPUT_TOKENS * len(group)
+        )
+        stories = json.loads(response.text)
+        if not isinstance(stories, list) or len(stories) != len(group):
+            print(f"  [!] Fused call returned {len(stories) if isinstance(stories, list) else 'non-array'} for {len(group)} levels.")
+            return None
+        for (level, _, _), story in zip(group, stories):
+            error = validate_story(story)
+            if error is not None:
+                # Per-level fallback gets its own validation + nudge loop.
+                print(f"  [!] Fused output for level {level} failed schema ({error}).")
+                return None
+        return stories
+    except Exception as e:
+        print(f"Error on fused call for levels {group[0][0]}-{group[-1][0]}: {e}")
+        return None
+
 def process_and_save_image(image_bytes, output_path):
     try:
-        img = Image.open(io.BytesIO(image_bytes))
-        img = img.resize((512, 512), Image.Resampling.LANCZOS)
-        img.convert("RGB").save(output_path, "JPEG", quality=70) 
+        if pyvips is not None:
+            # Shrink-on-load thumbnail path; LANCZOS-equivalent filter.
+            img = pyvips.Image.thumbnail_buffer(image_bytes, 512, height=512, crop="centre")
+            img.jpegsave(str(output_path), Q=70, optimize_coding=True, strip=True)
+        else:
+            img = Image.open(io.BytesIO(image_bytes))
+            # libjpeg DCT scaling: Imagen returns 1024x1024 JPEGs, so
+            # draft() decodes straight to ~512px inside the IDCT instead
+            # of full-res decode + downscale. No-op for non-JPEG input.
+            img.draft("RGB", (512, 512))
+            if img.size != (512, 512):
+                img = img.resize((512, 512), Image.Resampling.LANCZOS)
+            img.convert("RGB").save(output_path, "JPEG", quality=70, optimize=True)
         print(f"  [+] Saved: {output_path} (512x512 Q70 Magritte)")
     except Exception as e:
         print(f"  [!] Optimizing failed: {e}")
 
-def generate_image(client, prompt, output_path):
+def image_missing(output_path):
+    # Zero-byte files count as missing (a crashed save leaves them behind).
+    return not (output_path.exists() and output_path.stat().st_size > 0)
+
+# Prompt-dedup cache: sha256(prompt) -> path of an already-rendered
+# image. Identical prompts (within or across runs) cost one copy instead
+# of a second Imagen call. Persisted beside the other sidecars.
+_image_prompt_cache = None
+
+def _get_image_cache():
+    global _image_prompt_cache
+    if _image_prompt_cache is None:
+        _image_prompt_cache = {}
+        if IMAGE_CACHE_PATH.exists():
+            try:
+                _image_prompt_cache = json.loads(IMAGE_CACHE_PATH.read_text())
+            except Exception:
+                pass
+    return _image_prompt_cache
+
+def resolve_cached_image(prompt, output_path):
+    # True if the output could be satisfied by copying an earlier render.
+    cache = _get_image_cache()
+    key = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    source = cache.get(key)
+    if source and Path(source).exists() and Path(source).stat().st_size > 0:
+        if Path(source) != output_path:
+            shutil.copyfile(source, output_path)
+        print(f"  = Duplicate prompt, copied {Path(source).name} -> {output_path.name}")
+        return True
+    return False
+
+def record_image(prompt, output_path):
+    cache = _get_image_cache()
+    key = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    cache[key] = str(output_path)
+    IMAGE_CACHE_PATH.write_text(json.dumps(cache, separators=(',', ':')))
+
+async def generate_image(client, limiter, prompt, output_path):
+    if not image_missing(output_path):
+        print(f"  = Image exists, skipping: {output_path.name}")
+        return
+    if resolve_cached_image(prompt, output_path):
+        return
     print(f"  > Gen Image: {prompt[:50]}...")
     try:
-        response = client.models.generate_images(
-            model='imagen-4.0-generate-001', # Hardcoded 4.0
-            prompt=prompt,
-            config=types.GenerateImagesConfig(number_of_images=1)
+        response = await with_retries(
+            limiter, f"image {output_path.name}",
+            lambda: client.aio.models.generate_images(
+                model='imagen-4.0-generate-001', # Hardcoded 4.0
+                prompt=prompt,
+                config=types.GenerateImagesConfig(number_of_images=1)
+            ),
+            estimated_tokens=len(prompt) // 4
         )
         if response.generated_images:
-            process_and_save_image(response.generated_images[0].image.image_bytes, output_path)
+            # PIL decode/resize/encode is CPU-bound; keep it off the event
+            # loop so in-flight requests aren't stalled behind it.
+            await asyncio.to_thread(process_and_save_image, response.generated_images[0].image.image_bytes, output_path)
+            record_image(prompt, output_path)
         else:
             print("  [!] No images returned.")
     except Exception as e:
         print(f"  [!] Imagen Error: {e}")
 
-def main():
+async def _gated(sem, coro):
+    async with sem:
+        return await coro
+
+def spawn_entry_images(sem, client, limiter, entry, level, pending_images):
+    # Detach image generation as free-running tasks: the level's slot is
+    # released as soon as its text is written, so the next level's text
+    # call never queues behind image rendering. main gathers the tasks
+    # before exit.
+    for choice, suffix in (("choice_a", "A"), ("choice_b", "B")):
+        if entry.get(choice):
+            task = asyncio.create_task(_gated(sem, generate_image(
+                client, limiter, entry[choice].get("image_prompt", "magritte scene"),
+                ASSETS_DIR / f"story_{level}_{suffix}.jpg")))
+            pending_images.append(task)
+
+async def process_level(sem, client, limiter, level, new_batch, legacy, cache_name, model_used, bible_data, jsonl_f, pending_images):
+    # The semaphore gates individual API calls, not the whole level:
+    # while this level's images render, the next level's text call can
+    # already be in flight, so per-level wall time tends toward
+    # max(T_text, T_image) instead of their sum.
+    story = await _gated(sem, generate_cyoa_content(client, limiter, level, new_batch, legacy, cache_name, model_used, bible_data))
+
+    if not story:
+        print(f"Skipping L{level}")
+        return False
+
+    entry = {
+        "level": level,
+        "target_words": new_batch,
+        "legacy_words": legacy,
+        "choice_a": story.get("choice_a"),
+        "choice_b": story.get("choice_b")
+    }
+    append_entry(jsonl_f, entry)
+    checkpoint_entries(jsonl_f)
+    spawn_entry_images(sem, client, limiter, entry, level, pending_images)
+
+    print(f"Level {level} Complete.")
+    return True
+
+async def process_level_group(sem, client, limiter, group, cache_name, model_used, bible_data, jsonl_f, pending_images):
+    # Try one fused request for the whole group; fall back to the
+    # per-level path if the model can't hold the array contract.
+    if len(group) > 1:
+        stories = await _gated(sem, generate_cyoa_multi(client, limiter, group, cache_name, model_used, bible_data))
+        if stories is not None:
+            for (level, new_batch, legacy), story in zip(group, stories):
+                entry = {
+                    "level": level,
+                    "target_words": new_batch,
+                    "legacy_words": legacy,
+                    "choice_a": story.get("choice_a"),
+                    "choice_b": story.get("choice_b")
+                }
+                append_entry(jsonl_f, entry)
+                spawn_entry_images(sem, client, limiter, entry, level, pending_images)
+                print(f"Level {level} Complete.")
+            checkpoint_entries(jsonl_f)
+            return len(group)
+        print(f"Falling back to per-level calls for levels {group[0][0]}-{group[-1][0]}.")
+
+    results = await asyncio.gather(*(
+        process_level(sem, client, limiter, lvl, nb, lg, cache_name, model_used, bible_data, jsonl_f, pending_images)
+        for lvl, nb, lg in group))
+    return sum(1 for r in results if r)
+
+# Whether the installed SDK accepts a prompt list in one generate_images
+# call. Probed by the first fused attempt; a client-side rejection flips
+# it off so later chunks skip straight to singleton calls instead of
+# re-probing (and re-failing) per chunk.
+_fused_imagen_supported = True
+
+async def generate_image_chunk(sem, client, limiter, chunk):
+    # Fuse up to IMAGE_BATCH prompts into one Imagen request to amortize
+    # the round-trip; fall back to singleton calls if the SDK/model
+    # rejects the list form or returns a mismatched count.
+    global _fused_imagen_supported
+    async with sem:
+        # Drop anything satisfiable without an API call (already on disk
+        # or an identical prompt rendered earlier).
+        chunk = [(p, path) for p, path in chunk
+                 if image_missing(path) and not resolve_cached_image(p, path)]
+        if not chunk:
+            return
+        if len(chunk) == 1 or not _fused_imagen_supported:
+            for prompt, output_path in chunk:
+                await generate_image(client, limiter, prompt, output_path)
+            return
+
+        prompts = [p for p, _ in chunk]
+        try:
+            response = await with_retries(
+                limiter, f"fused imagen x{len(chunk)}",
+                lambda: client.aio.models.generate_images(
+                    model='imagen-4.0-generate-001',
+                    prompt=prompts,
+                    config=types.GenerateImagesConfig(number_of_images=1)
+                ),
+                estimated_tokens=sum(len(p) for p in prompts) // 4
+            )
+            generated = response.generated_images or []
+            if len(generated) == len(chunk):
+                for (chunk_prompt, output_path), img in zip(chunk, generated):
+                    await asyncio.to_thread(process_and_save_image, img.image.image_bytes, output_path)
+                    record_image(chunk_prompt, output_path)
+                return
+            print(f"  [!] Fused call returned {len(generated)}/{len(chunk)} images; retrying individually.")
+        except (TypeError, ValueError) as e:
+            # SDK rejected the list form before any HTTP request; don't
+            # probe again this run.
+            _fused_imagen_supported = False
+            print(f"  [!] SDK rejected the fused prompt list ({e}); using single calls from here on.")
+        except Exception as e:
+            print(f"  [!] Fused Imagen call rejected ({e}); falling back to single calls.")
+
+        for prompt, output_path in chunk:
+            await generate_image(client, limiter, prompt, output_path)
+
+async def run_batch_job(client, jobs, model_name, bible_data, anchor_words, jsonl_f, sem, limiter):
+    # Batch API: ~50% of interactive pricing and no RPM ceiling, at the
+    # cost of latency. Story generation isn't latency-sensitive, so this
+    # is the default path; --realtime keeps the interactive one.
+    if not jobs:
+        # Everything already generated; batches.create rejects an empty src.
+        return 0
+    system_instruction = build_system_instruction(bible_data, anchor_words)
+    src = []
+    for level, new_batch, legacy in jobs:
+        prompt, context = build_level_prompt(level, new_batch, legacy, bible_data)
+        print(f"Queueing LEVEL {level} [Magritte Style] @ {context['location']} -> {context['destination']}")
+        src.append({
+            'contents': prompt,
+            'config': {
+                'response_mime_type': 'application/json',
+                'max_output_tokens': MAX_OUTPUT_TOKENS,
+                'temperature': GEN_TEMPERATURE,
+                'system_instruction': system_instruction
+            }
+        })
+
+    print(f"Submitting Batch API job for {len(src)} levels...")
+    batch_job = client.batches.create(
+        model=model_name,
+        src=src,
+        config={'display_name': 'magritte_factory_batch'}
+    )
+
+    terminal_states = {'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'}
+    while batch_job.state.name not in terminal_states:
+        print(f"  ... job {batch_job.name}: {batch_job.state.name}, polling again in 30s")
+        await asyncio.sleep(30)
+        batch_job = client.batches.get(name=batch_job.name)
+
+    if batch_job.state.name != 'JOB_STATE_SUCCEEDED':
+        print(f"Batch job ended in {batch_job.state.name}. Nothing written.")
+        return 0
+
+    # Map results back to levels by index.
+    image_jobs = []
+    completed = 0
+    for (level, new_batch, legacy), inline in zip(jobs, batch_job.dest.inlined_responses):
+        if inline.error:
+            print(f"  [!] Batch error for level {level}: {inline.error}")
+            continue
+        try:
+            story = json.loads(inline.response.text)
+        except Exception as e:
+            print(f"  [!] Unparseable batch response for level {level}: {e}")
+            continue
+        error = validate_story(story)
+        if error is not None:
+            # No synchronous retry path in batch mode; leave the level
+            # for the next run rather than rendering images for it.
+            print(f"  [!] Batch response for level {level} failed schema ({error}); skipping.")
+            continue
+
+        entry = {
+            "level": level,
+            "target_words": new_batch,
+            "legacy_words": legacy,
+            "choice_a": story.get("choice_a"),
+            "choice_b": story.get("choice_b")
+        }
+        append_entry(jsonl_f, entry)
+        completed += 1
+
+        for choice, suffix in (("choice_a", "A"), ("choice_b", "B")):
+            img_path = ASSETS_DIR / f"story_{level}_{suffix}.jpg"
+            if entry.get(choice) and image_missing(img_path):
+                image_jobs.append((entry[choice].get("image_prompt", "magritte scene"), img_path))
+    if completed:
+        checkpoint_entries(jsonl_f)
+
+    image_tasks = [generate_image_chunk(sem, client, limiter, image_jobs[i:i+IMAGE_BATCH])
+                   for i in range(0, len(image_jobs), IMAGE_BATCH)]
+    await asyncio.gather(*image_tasks)
+    return completed
+
+async def main_async():
     args = setup_args()
     if not ASSETS_DIR.exists(): ASSETS_DIR.mkdir(parents=True)
 
+    if args.compact:
+        compact_stories()
+        return
+
     client = configure_client()
     all_vocab = read_vocab(CSV_PATH)
     bible_data = read_json_file(BIBLE_PATH)
-    
+
     if not bible_data:
         print("Error: No Narrative Bible found.")
         return
 
     anchor_words = get_anchor_words(all_vocab)
-    cache_name, model_used = create_story_cache(client, bible_data, anchor_words)
-    
-    # Load existing
-    current_data = []
-    if OUTPUT_JSON.exists():
-        try:
-            with open(OUTPUT_JSON, 'r') as f: current_data = json.load(f)
-        except: current_data = []
 
-    next_level = 1
-    if current_data:
-        next_level = max([d.get('level', 0) for d in current_data]) + 1
-    if args.start_batch > 0:
-        next_level = args.start_batch
+    # Resume from whatever stories.json + stories.jsonl already hold.
+    current_data = load_existing_entries()
+    done_levels = {d.get('level') for d in current_data}
 
-    print(f"Starting Magritte Factory. Batch Limit: {args.limit}")
-    
-    processed = 0
-    start_index = (next_level - 1) * BATCH_SIZE
+    next_level = max((d.get('level', 0) for d in current_data), default=0) + 1
+    print(f"{len(done_levels)} levels already generated; next new level would be {next_level}.")
+
+    print(f"Starting Magritte Factory. Batch Limit: {args.limit}, Concurrency: {args.max_concurrency}, Mode: {'realtime' if args.realtime else 'batch'}")
+
+    # Plan all pending levels up front, skipping anything already done —
+    # a gap in the middle (one failed level) no longer regenerates the
+    # whole tail, and --start-batch won't burn quota on existing levels.
+    jobs = []
     total_words = len(all_vocab)
+    start_level = args.start_batch if args.start_batch > 0 else 1
+
+    for i in range((start_level - 1) * BATCH_SIZE, total_words, BATCH_SIZE):
+        if len(jobs) >= args.limit: break
+
+        level = i // BATCH_SIZE + 1
+        if level in done_levels:
+            continue
 
-    for i in range(start_index, total_words, BATCH_SIZE):
-        if processed >= args.limit: break
-        
-        # Words
         new_batch = all_vocab[i:i+BATCH_SIZE]
         if not new_batch: break
         legacy = get_legacy_words(all_vocab, i)
-        
-        # Text
-        story = generate_cyoa_content(client, next_level, new_batch, legacy, cache_name, model_used, bible_data)
-        
-        if story:
-            entry = {
-                "level": next_level,
-                "target_words": new_batch,
-                "legacy_words": legacy,
-                "choice_a": story.get("choice_a"),
-                "choice_b": story.get("choice_b")
-            }
-            current_data.append(entry)
-            
-            # Save JSON
-            with open(OUTPUT_JSON, 'w') as f:
-                json.dump(current_data, f, indent=2, ensure_ascii=False)
-                
-            # Images
-            if entry.get("choice_a"):
-                generate_image(client, entry["choice_a"].get("image_prompt", "magritte scene"), ASSETS_DIR / f"story_{next_level}_A.jpg")
-            if entry.get("choice_b"):
-                generate_image(client, entry["choice_b"].get("image_prompt", "magritte scene"), ASSETS_DIR / f"story_{next_level}_B.jpg")
-                
-            print(f"Level {next_level} Complete.")
-            next_level += 1
-            processed += 1
-            if processed < args.limit: time.sleep(1)
-            
+
+        jobs.append((level, new_batch, legacy))
+
+    sem = asyncio.Semaphore(args.max_concurrency)
+    limiter = RateLimiter()
+
+    # Binary append with an explicit 1MB buffer: entries accumulate in
+    # user space and hit disk at checkpoint_entries calls.
+    with open(OUTPUT_JSONL, 'ab', buffering=1 << 20) as jsonl_f:
+        if args.realtime:
+            cache_name, model_used = create_story_cache(client, bible_data, anchor_words)
+            group_size = max(1, args.levels_per_call)
+            groups = [jobs[i:i+group_size] for i in range(0, len(jobs), group_size)]
+            pending_images = []
+            tasks = [process_level_group(sem, client, limiter, g, cache_name, model_used, bible_data, jsonl_f, pending_images)
+                     for g in groups]
+            results = await asyncio.gather(*tasks)
+            # Drain the free-running image tasks before closing the stream.
+            if pending_images:
+                await asyncio.gather(*pending_images)
+            completed = sum(results)
         else:
-            print(f"Skipping L{next_level}")
+            completed = await run_batch_job(client, jobs, 'gemini-2.5-flash', bible_data, anchor_words, jsonl_f, sem, limiter)
+
+    # Re-materialize the array form the app ships; the JSONL stream was
+    # only the crash-safe intermediate representation.
+    if completed:
+        compact_stories()
+
+    print(f"Done. {completed}/{len(jobs)} levels completed.")
+
+def main():
+    asyncio.run(main_async())
 
 if __name__ == "__main__":
     main()
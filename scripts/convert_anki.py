@@ -1,10 +1,18 @@
 import csv
 import os
+import re
 
 # Input and Output paths
 INPUT_FILE = "anki_export.txt"
 OUTPUT_FILE = "app/src/main/res/raw/german_4000.csv"
 
+# Keep only the first LIMIT cards; everything past that is never written.
+LIMIT = 1000
+
+# Compiled once (same pattern as parse_anki_final); strips all tags, not
+# just the <b> pairs the old replace chain caught.
+_HTML_RE = re.compile(r'<[^<]+?>')
+
 def convert_anki_to_csv():
     print(f"Reading from {INPUT_FILE}...")
     
@@ -46,20 +54,21 @@ def convert_anki_to_csv():
                 example_de = row[2].strip() if len(row) > 2 else ""
                 example_en = row[3].strip() if len(row) > 3 else ""
 
-                # Basic cleanup (remove HTML tags if any - rudimentary)
-                german = german.replace("<b>", "").replace("</b>", "")
-                english = english.replace("<b>", "").replace("</b>", "")
+                # Basic cleanup (remove HTML tags if any)
+                german = _HTML_RE.sub('', german)
+                english = _HTML_RE.sub('', english)
 
                 cards.append([german, english, example_de, example_en])
-    
+
+                # Stop reading once we have enough: no point stripping
+                # HTML from rows that get truncated anyway.
+                if len(cards) >= LIMIT:
+                    break
+
     except Exception as e:
         print(f"Error reading file: {e}")
         return
 
-    # Filter/Limit
-    print(f"Total rows found: {len(cards)}")
-    limit = 1000
-    cards = cards[:limit]
     print(f"Keeping top {len(cards)} cards.")
 
     # Write to CSV
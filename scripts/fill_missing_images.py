@@ -1,42 +1,106 @@
+import asyncio
 import os
 import json
-import time
+import httpx
 from google import genai
 from google.genai import types
 from PIL import Image
 import io
 
+# Optional fast image backend (see content_factory): libvips beats stock
+# Pillow on resize+encode; PIL remains the fallback.
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+# Optional fast JSON backend for the multi-MB manifest; stdlib fallback.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # --- CONFIGURATION ---
 ASSETS_DIR = "app/src/main/assets"
 MANIFEST_FILE = os.path.join(ASSETS_DIR, "stories.json")
 TARGET_SIZE = (512, 512) # Resize to this (Width, Height)
 IMAGE_QUALITY = 75       # JPG Quality (1-100)
+MAX_CONCURRENCY = 5      # Imagen requests in flight at once
 # ---------------------
 
 def compress_and_save(image_bytes, output_path):
     """Resizes and compresses image bytes before saving."""
     try:
-        # 1. Open image from bytes
-        img = Image.open(io.BytesIO(image_bytes))
-        
-        # 2. Resize (Antialias)
-        img = img.resize(TARGET_SIZE, Image.Resampling.LANCZOS)
-        
-        # 3. Save with compression
-        img.save(output_path, "JPEG", quality=IMAGE_QUALITY, optimize=True)
+        if pyvips is not None:
+            # Shrink-on-load; LANCZOS-equivalent filter.
+            img = pyvips.Image.thumbnail_buffer(image_bytes, TARGET_SIZE[0], height=TARGET_SIZE[1], crop="centre")
+            img.jpegsave(str(output_path), Q=IMAGE_QUALITY, optimize_coding=True, strip=True)
+        else:
+            # 1. Open image from bytes
+            img = Image.open(io.BytesIO(image_bytes))
+
+            # 1b. libjpeg DCT scaling: decode directly near TARGET_SIZE
+            # instead of full-res + downscale (no-op for non-JPEG).
+            img.draft("RGB", TARGET_SIZE)
+
+            # 2. Resize (Antialias) for whatever draft couldn't reach
+            if img.size != TARGET_SIZE:
+                img = img.resize(TARGET_SIZE, Image.Resampling.LANCZOS)
+
+            # 3. Save with compression
+            img.save(output_path, "JPEG", quality=IMAGE_QUALITY, optimize=True)
         print(f"  [✔] Saved Optimized Image: {output_path}")
         return True
     except Exception as e:
         print(f"  [!] Optimization Error: {e}")
         return False
 
-def main():
+async def backfill_image(sem, client, batch_id, image_prompt, output_path):
+    async with sem:
+        print(f"Generating Image for Batch {batch_id}...")
+
+        try:
+            # 3. Call Imagen 4
+            response = await client.aio.models.generate_images(
+                model='imagen-4.0-generate-001', # Or 'imagen-4.0-generate-001' if available
+                prompt=image_prompt,
+                config=types.GenerateImagesConfig(
+                    number_of_images=1,
+                    aspect_ratio="1:1" # Square aspect ratio
+                )
+            )
+
+            if response.generated_images:
+                # 4. Resize & Save (PIL work off the event loop)
+                raw_bytes = response.generated_images[0].image.image_bytes
+                await asyncio.to_thread(compress_and_save, raw_bytes, output_path)
+            else:
+                print(f"  [!] API returned no images for Batch {batch_id}")
+
+        except Exception as e:
+            print(f"  [!] Failed to generate image for Batch {batch_id}: {e}")
+
+async def main_async():
     api_key = os.environ.get("GOOGLE_API_KEY")
     if not api_key:
         print("Error: GOOGLE_API_KEY environment variable not set.")
         return
 
-    client = genai.Client(api_key=api_key)
+    # Same transport setup as content_factory: HTTP/2 so the concurrent
+    # Imagen calls multiplex over one warm TLS connection, 60s cap per
+    # attempt with SDK-level retries. Requires httpx[http2] (h2).
+    client = genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            timeout=60_000,
+            retry_options=types.HttpRetryOptions(attempts=3, initial_delay=1.0, exp_base=2.0),
+            async_client_args={
+                'http2': True,
+                'timeout': httpx.Timeout(600, connect=5),
+                'limits': httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0),
+            }
+        )
+    )
 
     # 1. Load the Manifest
     if not os.path.exists(MANIFEST_FILE):
@@ -44,57 +108,40 @@ def main():
         return
 
     try:
-        with open(MANIFEST_FILE, "r") as f:
-            stories = json.load(f)
-    except json.JSONDecodeError:
+        with open(MANIFEST_FILE, "rb") as f:
+            raw = f.read()
+        stories = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    except ValueError:
         print("Error: stories.json is corrupt or empty.")
         return
 
     print(f"Loaded {len(stories)} stories from manifest.")
 
-    # 2. Iterate and Backfill
+    # 2. Collect missing images, then backfill them concurrently. The
+    # semaphore bounds in-flight requests; no more fixed 4s sleep per image.
+    missing = []
     for story in stories:
         batch_id = story.get("batch_id")
         image_prompt = story.get("image_prompt")
-        
+
         if not batch_id or not image_prompt:
             continue
 
-        filename = f"story_{batch_id}.jpg"
-        output_path = os.path.join(ASSETS_DIR, filename)
+        output_path = os.path.join(ASSETS_DIR, f"story_{batch_id}.jpg")
 
-        # CHECK: Does the image already exist?
         if os.path.exists(output_path):
             print(f"Skipping Batch {batch_id}: Image already exists.")
             continue
 
-        print(f"Generating Image for Batch {batch_id}...")
-        
-        try:
-            # 3. Call Imagen 4
-            response = client.models.generate_images(
-                model='imagen-4.0-generate-001', # Or 'imagen-4.0-generate-001' if available
-                prompt=image_prompt,
-                config=types.GenerateImagesConfig(
-                    number_of_images=1,
-                    aspect_ratio="1:1" # Square aspect ratio
-                )
-            )
-
-            if response.generated_images:
-                # 4. Resize & Save
-                raw_bytes = response.generated_images[0].image.image_bytes
-                compress_and_save(raw_bytes, output_path)
-            else:
-                print(f"  [!] API returned no images for Batch {batch_id}")
+        missing.append((batch_id, image_prompt, output_path))
 
-            # Sleep to respect rate limits
-            time.sleep(4) 
-
-        except Exception as e:
-            print(f"  [!] Failed to generate image for Batch {batch_id}: {e}")
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    await asyncio.gather(*(backfill_image(sem, client, *item) for item in missing))
 
     print("\n--- Backfill Complete ---")
 
+def main():
+    asyncio.run(main_async())
+
 if __name__ == "__main__":
     main()
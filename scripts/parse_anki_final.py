@@ -2,99 +2,73 @@ import csv
 import re
 import os
 
+import pandas as pd
+
 # Configuration
 INPUT_FILE = "anki_export.txt"
 OUTPUT_FILE = "app/src/main/res/raw/german_4000.csv"
 
+# Compiled once at import; clean_text and the vectorized cleanup below
+# share it instead of re-looking the pattern up per call.
+_HTML_RE = re.compile(r'<[^<]+?>')
+
 def clean_text(text):
     """Removes HTML tags, extra whitespace, and quotes."""
     if not text:
         return ""
-    # Remove HTML tags
-    clean = re.sub('<[^<]+?>', '', text)
-    # Remove extra whitespace
-    clean = clean.strip()
-    return clean
+    return _HTML_RE.sub('', text).strip()
 
 def main():
     print(f"Processing {INPUT_FILE}...")
-    
+
     if not os.path.exists(INPUT_FILE):
         print(f"Error: {INPUT_FILE} not found.")
         return
 
-    cards = []
-    skipped_metadata = 0
-    skipped_short = 0
-    success_count = 0
-
+    # 1. Read with pandas' C tokenizer. comment='#' drops the Anki
+    # metadata header lines, QUOTE_NONE keeps embedded quotes,
+    # on_bad_lines skips malformed rows instead of crashing, and
+    # na_filter=False stops literal card text like "null" or "NA" from
+    # being converted to NaN and dropped.
     try:
-        with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-            for line_num, line in enumerate(f, 1):
-                clean_line = line.strip()
-                
-                # 1. Skip Headers / Metadata
-                if clean_line.startswith('#'):
-                    skipped_metadata += 1
-                    continue
-                
-                if not clean_line:
-                    continue
-
-                # 2. Split by Tab
-                parts = line.split('\t') # Do not strip line before split to preserve tab counts if empty at end? 
-                                         # Actually Anki export usually has tabs. `line.strip()` above removed newline.
-                                         # But `split('\t')` on a stripped line is fine.
-                                         # Wait, if I strip, I might lose trailing empty fields if they are tab separated?
-                                         # But `line.strip()` removes whitespace from ends.
-                                         # Let's use `line.rstrip('\n')` to be safer about tabs.
-                
-                parts = line.rstrip('\n').split('\t')
-
-                # 3. Column Mapping (0-based)
-                # German: 1
-                # English: 4
-                # Sentence (DE): 5
-                # Sentence (EN): 6
-                
-                # We need at least index 6 to exist (7 columns)
-                if len(parts) < 7:
-                    skipped_short += 1
-                    continue
-
-                try:
-                    raw_german = clean_text(parts[1])
-                    english = clean_text(parts[4])
-                    sent_de = clean_text(parts[5])
-                    sent_en = clean_text(parts[6])
-
-                    if not raw_german:
-                        continue
+        df = pd.read_csv(
+            INPUT_FILE, sep='\t', comment='#', header=None, dtype=str,
+            engine='c', quoting=csv.QUOTE_NONE, encoding='utf-8',
+            on_bad_lines='skip', na_filter=False
+        )
+    except Exception as e:
+        print(f"Critical Error reading file: {e}")
+        return
 
-                    # 4. Cleaning German: Take part before first comma
-                    german = raw_german.split(',')[0].strip()
+    total_rows = len(df)
 
-                    cards.append([german, english, sent_de, sent_en])
-                    success_count += 1
+    # 2. Column Mapping (0-based): German 1, English 4, Sentence (DE) 5,
+    # Sentence (EN) 6. We need at least index 6 to exist (7 columns);
+    # short rows come back padded with empty strings.
+    if df.shape[1] < 7:
+        print(f"Error: Expected at least 7 columns, found {df.shape[1]}.")
+        return
+    df = df[df[6] != '']
+    skipped_short = total_rows - len(df)
 
-                except IndexError:
-                    skipped_short += 1
-                    continue
+    # 3. Vectorized cleanup (same semantics as clean_text)
+    for col in (1, 4, 5, 6):
+        df[col] = (df[col]
+                   .str.replace(_HTML_RE, '', regex=True)
+                   .str.strip())
 
-    except Exception as e:
-        print(f"Critical Error reading file: {e}")
-        return
+    # 4. Cleaning German: Take part before first comma
+    df[1] = df[1].str.split(',', n=1).str[0].str.strip()
+    df = df[df[1] != '']
+    success_count = len(df)
 
     # 5. Output to CSV
     try:
-        with open(OUTPUT_FILE, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f, delimiter='|')
-            # Headers: german,english,example_de,example_en
-            writer.writerow(["german", "english", "example_de", "example_en"])
-            writer.writerows(cards)
-            
-        print(f"Success! Processed {line_num} lines.")
-        print(f"  - Skipped (Metadata): {skipped_metadata}")
+        out = df[[1, 4, 5, 6]]
+        out.columns = ["german", "english", "example_de", "example_en"]
+        out.to_csv(OUTPUT_FILE, sep='|', index=False, encoding='utf-8')
+
+        print(f"Success! Processed {total_rows} rows.")
         print(f"  - Skipped (Too short): {skipped_short}")
         print(f"  - Extracted: {success_count}")
         print(f"Wrote to {OUTPUT_FILE}")